@@ -3,8 +3,9 @@
 """
 import os
 import re
-from fnmatch import fnmatch
-from glob import glob
+from concurrent.futures import ThreadPoolExecutor
+import fnmatch
+from functools import partial
 from pathlib import Path
 from typing import List
 
@@ -12,11 +13,37 @@ from docutils import nodes
 from sphinx.util.docutils import SphinxDirective
 from sphinx.util.logging import getLogger
 
+try:
+    # Fails for modules named re2 that are not google-re2
+    from re2 import compile as _re2_compile, error as _re2_error
+except (ImportError, AttributeError):
+    _re2_compile = None
+
+try:
+    from sphinx_design.badges_buttons import XRefBadgeRole
+except ImportError:
+    XRefBadgeRole = None
+
 __version__ = "0.2.1"
 
 logger = getLogger("sphinx-tags")
 
 
+def _compile_regex(pattern, flags=0):
+    """Compile a regex with re2 if it is installed, falling back to re.
+
+    re2 guarantees matching in linear time, which matters when scanning
+    whole (possibly large) source files. Patterns or flags that re2 does
+    not support are compiled with the standard library instead.
+    """
+    if _re2_compile is not None and not flags & ~re.DOTALL:
+        try:
+            return _re2_compile(f"(?s){pattern}" if flags else pattern)
+        except _re2_error:
+            pass
+    return re.compile(pattern, flags)
+
+
 class TagLinks(SphinxDirective):
     """Custom directive for adding tags to Sphinx-generated files.
 
@@ -37,50 +64,56 @@ class TagLinks(SphinxDirective):
 
     def run(self):
         tags = [arg.strip() for arg in self.arguments[0].split(self.separator)]
-        tag_dir = Path(self.env.app.srcdir) / self.env.app.config.tags_output_dir
+        # Drop duplicate and empty tags, as Entry does for the tag pages
+        tags = [tag for tag in dict.fromkeys(tags) if tag]
+        tag_dir = os.path.join(self.env.app.srcdir, self.env.app.config.tags_output_dir)
         result = nodes.paragraph()
         result["classes"] = ["tags"]
         result += nodes.inline(text=f"{self.env.app.config.tags_intro_text} ")
         count = 0
+        # We want the link to be the path to the _tags folder, relative to
+        # this document's path where
+        #
+        #  - self.env.app.config.tags_output_dir
+        # |
+        #  - subfolder
+        #   |
+        #    - current_doc_path
+        current_doc_dir = os.path.dirname(self.env.doc2path(self.env.docname))
+        # Links always use forward slashes, even on Windows
+        relative_tag_dir = os.path.relpath(tag_dir, current_doc_dir).replace(
+            os.sep, "/"
+        )
+        create_badges = self.env.app.config.tags_create_badges
+        tag_separator = " " if create_badges else f"{self.separator} "
 
         for tag in tags:
             count += 1
-            # We want the link to be the path to the _tags folder, relative to
-            # this document's path where
-            #
-            #  - self.env.app.config.tags_output_dir
-            # |
-            #  - subfolder
-            #   |
-            #    - current_doc_path
-            current_doc_dir = Path(self.env.doc2path(self.env.docname)).parent
-            relative_tag_dir = Path(os.path.relpath(tag_dir, current_doc_dir))
-
-            if self.env.app.config.tags_create_badges:
+            if create_badges:
                 result += self._get_badge_node(tag, relative_tag_dir)
-                tag_separator = " "
             else:
                 result += self._get_plaintext_node(tag, relative_tag_dir)
-                tag_separator = f"{self.separator} "
             if not count == len(tags):
                 result += nodes.inline(text=tag_separator)
         return [result]
 
-    def _get_plaintext_node(self, tag: str, relative_tag_dir: Path) -> List[nodes.Node]:
+    def _get_plaintext_node(self, tag: str, relative_tag_dir: str) -> List[nodes.Node]:
         """Get a plaintext reference link for the given tag"""
-        link = relative_tag_dir / f"{tag.replace(' ', '_')}.html"
-        return nodes.reference(refuri=str(link), text=tag)
+        link = f"{relative_tag_dir}/{tag.replace(' ', '_')}.html"
+        return nodes.reference(refuri=link, text=tag)
 
-    def _get_badge_node(self, tag: str, relative_tag_dir: Path) -> List[nodes.Node]:
+    def _get_badge_node(self, tag: str, relative_tag_dir: str) -> List[nodes.Node]:
         """Get a sphinx-design reference badge for the given tag"""
-        from sphinx_design.badges_buttons import XRefBadgeRole
+        if XRefBadgeRole is None:
+            raise ImportError(
+                "sphinx-design must be installed to use tags_create_badges = True"
+            )
 
         # Required to set Inliner state, since we're directly creating a role object.
         # Typically this would be done when parsing the role from document text.
         text_nodes, messages = self.state.inline_text("", self.lineno)
 
-        # Ref paths always use forward slashes, even on Windows
-        tag_ref = f"{tag} <{relative_tag_dir.as_posix()}/{tag.replace(' ', '_')}>"
+        tag_ref = f"{tag} <{relative_tag_dir}/{tag.replace(' ', '_')}>"
         tag_color = self._get_tag_color(tag)
         tag_badge = XRefBadgeRole(tag_color)
         return tag_badge(
@@ -95,11 +128,32 @@ class TagLinks(SphinxDirective):
         """Check for a matching user-defined color for a given tag.
         Defaults to theme's primary color.
         """
-        tag_colors = self.env.app.config.tags_badge_colors or {}
-        for pattern, color in tag_colors.items():
-            if fnmatch(tag, pattern):
-                return color
-        return "primary"
+        color_cache = self.env.app._tags_color_cache
+        if tag not in color_cache:
+            color_cache[tag] = "primary"
+            normalized_tag = os.path.normcase(tag)
+            for pattern, color in self.env.app._tags_color_patterns:
+                if pattern.match(normalized_tag):
+                    color_cache[tag] = color
+                    break
+        return color_cache[tag]
+
+
+def _write_if_changed(filename, lines):
+    """Write the given lines to filename, unless it already contains them.
+
+    Leaving unchanged files untouched keeps their modification time, so that
+    Sphinx does not read them again on incremental builds.
+    """
+    text = "".join(f"{line}\n" for line in lines)
+    try:
+        with open(filename, "r", encoding="utf8") as f:
+            if f.read() == text:
+                return
+    except FileNotFoundError:
+        pass
+    with open(filename, "w", encoding="utf8") as f:
+        f.write(text)
 
 
 class Tag:
@@ -144,74 +198,94 @@ class Tag:
         tag_intro_text: str
             the words after which the tags of a given page are listed (e.g. "Tags: programming, python")
 
+        Returns
+        -------
 
+        str
+            name of the file for this tag. The file is only rewritten if its
+            content changed.
         """
-        content = []
+        # Sort so that the generated page does not depend on file system order.
+        # Paths are compared by component (and case-insensitively on Windows),
+        # like pathlib does.
+        items = sorted(
+            items, key=lambda item: os.path.normcase(item.filepath).split(os.sep)
+        )
         if "md" in extension:
             filename = f"{self.name.replace(' ', '_')}.md"
-            content.append(f"# {tags_page_title}: {self.name}")
-            content.append("")
-            content.append("```{toctree}")
-            content.append("---")
-            content.append("maxdepth: 1")
-            content.append(f"caption: {tags_page_header}")
-            content.append("---")
-            #  items is a list of files associated with this tag
-            for item in items:
-                # We want here the filepath relative to /docs/_tags
-                # pathlib does not support relative paths for two absolute paths
-                relpath = Path(os.path.relpath(item.filepath, srcdir)).as_posix()
-                content.append(f"../{relpath}")
-            content.append("```")
+            lines = self._md_lines(items, tags_page_title, tags_page_header)
         else:
             filename = f"{self.name.replace(' ', '_')}.rst"
-            content.append(f"{tags_page_title}: {self.name}")
-            content.append("#" * (len(self.name) + len(tags_page_title) + 2))
-            content.append("")
-            #  Return link block at the start of the page"""
-            content.append(".. toctree::")
-            content.append("    :maxdepth: 1")
-            content.append(f"    :caption: {tags_page_header}")
-            content.append("")
-            #  items is a list of files associated with this tag
-            for item in sorted(items, key=lambda i: i.filepath):
-                # We want here the filepath relative to /docs/_tags
-                # pathlib does not support relative paths for two absolute paths
-                relpath = Path(os.path.relpath(item.filepath, srcdir)).as_posix()
-                content.append(f"    ../{relpath}")
-
-        content.append("")
-        with open(
-            os.path.join(srcdir, tags_output_dir, filename), "w", encoding="utf8"
-        ) as f:
-            f.write("\n".join(content))
+            lines = self._rst_lines(items, tags_page_title, tags_page_header)
+
+        _write_if_changed(os.path.join(srcdir, tags_output_dir, filename), lines)
+        return filename
+
+    def _md_lines(self, items, tags_page_title, tags_page_header):
+        """Generate the lines of the Markdown page for this tag"""
+        yield f"# {tags_page_title}: {self.name}"
+        yield ""
+        yield "```{toctree}"
+        yield "---"
+        yield "maxdepth: 1"
+        yield f"caption: {tags_page_header}"
+        yield "---"
+        for item in items:
+            yield f"../{item.relpath}"
+        yield "```"
+
+    def _rst_lines(self, items, tags_page_title, tags_page_header):
+        """Generate the lines of the reStructuredText page for this tag"""
+        yield f"{tags_page_title}: {self.name}"
+        yield "#" * (len(self.name) + len(tags_page_title) + 2)
+        yield ""
+        #  Return link block at the start of the page
+        yield ".. toctree::"
+        yield "    :maxdepth: 1"
+        yield f"    :caption: {tags_page_header}"
+        yield ""
+        for item in items:
+            yield f"    ../{item.relpath}"
 
 
 class Entry:
     """Extracted info from source file (*.rst/*.md/*.ipynb)"""
-    _rst_regex = re.compile(r"(?:^|\n)\.\. tags::(.*?)(?=\n\n|$)", re.DOTALL)
-    _md_regex = re.compile(r"```{tags}(.*?)```", re.DOTALL)
-    # TODO: Handle multiline 'tags' directives in .ipynb files
-    _nb_regex = re.compile(r'"\.\. tags::(.*)\\n"')
 
-    def __init__(self, entrypath):
-        self.filepath = Path(entrypath)
-        with open(self.filepath, "r", encoding="utf8") as f:
-            self.lines = f.read().split("\n")
-        if self.filepath.name.endswith(".rst"):
-            tag_regex = self._rst_regex
-        elif self.filepath.name.endswith(".md"):
-            tag_regex = self._md_regex
-        elif self.filepath.name.endswith(".ipynb"):
-            tag_regex = self._nb_regex
-        else:
+    # Everything up to the next blank line (or the end of the file)
+    _rst_regex = _compile_regex(r"(?:^|\n)\.\. tags::([^\n]*(?:\n[^\n]+)*)")
+    _md_regex = _compile_regex(r"```{tags}(.*?)```", re.DOTALL)
+    # TODO: Handle multiline 'tags' directives in .ipynb files
+    _nb_regex = _compile_regex(r'"\.\. tags::(.*)\\n"')
+    _regex_by_suffix = {".rst": _rst_regex, ".md": _md_regex, ".ipynb": _nb_regex}
+    # Number of characters searched for tags at the start of .ipynb files
+    _nb_read_limit = 65536
+
+    def __init__(self, entrypath, srcdir):
+        self.filepath = entrypath
+        # Path relative to the source dir, used to link to the entry from
+        # every tag page that lists it
+        self.relpath = os.path.relpath(entrypath, srcdir).replace(os.sep, "/")
+        tag_regex = self._regex_by_suffix.get(os.path.splitext(entrypath)[1])
+        if tag_regex is None:
             raise ValueError(
                 "Unknown file extension. Currently, only .rst, .md .ipynb are supported."
             )
-
-        self.tags = []
-        for match in tag_regex.finditer("\n".join(self.lines)):
-            self.tags.extend(tag.strip() for tag in match.group(1).split(","))
+        # Notebooks can be very large (e.g. images embedded in cell outputs),
+        # but their tags are expected in a raw cell near the top
+        size = self._nb_read_limit if tag_regex is self._nb_regex else -1
+        with open(self.filepath, "r", encoding="utf8") as f:
+            text = f.read(size)
+
+        # Tags are the keys of a dict, which drops duplicates but keeps order
+        self.tags = {}
+        # Most pages are untagged; skip the regex search when it cannot match
+        if "tags" not in text:
+            return
+        for match in tag_regex.finditer(text):
+            for tag in match.group(1).split(","):
+                tag = tag.strip()
+                if tag:
+                    self.tags[tag] = None
 
     def assign_to_tags(self, tag_dict):
         """Append ourself to tags"""
@@ -224,66 +298,99 @@ class Entry:
 def tagpage(tags, outdir, title, extension, tags_index_head):
     """Creates Tag overview page.
 
-    This page contains a list of all available tags.
+    This page contains a list of all available tags. Returns the name of the
+    page's file, which is only rewritten if its content changed.
 
     """
-    tags = list(tags.values())
+    tags = sorted(tags.values(), key=lambda t: t.name)
 
     if "md" in extension:
-        content = []
-        content.append("(tagoverview)=")
-        content.append("")
-        content.append(f"# {title}")
-        content.append("")
-        # toctree for this page
-        content.append("```{toctree}")
-        content.append("---")
-        content.append(f"caption: {tags_index_head}")
-        content.append("maxdepth: 1")
-        content.append("---")
-        for tag in sorted(tags, key=lambda t: t.name):
-            link = tag.name.replace(" ", "_")
-            content.append(f"{tag.name} ({len(tag.items)}) <{link}>")
-        content.append("```")
-        content.append("")
-        filename = os.path.join(outdir, "tagsindex.md")
+        filename = "tagsindex.md"
+        lines = _tagpage_md_lines(tags, title, tags_index_head)
     else:
-        content = []
-        content.append(":orphan:")
-        content.append("")
-        content.append(".. _tagoverview:")
-        content.append("")
-        content.append(title)
-        content.append("#" * len(title))
-        content.append("")
-        # toctree for the page
-        content.append(".. toctree::")
-        content.append(f"    :caption: {tags_index_head}")
-        content.append("    :maxdepth: 1")
-        content.append("")
-        for tag in sorted(tags, key=lambda t: t.name):
-            link = tag.name.replace(" ", "_")
-            content.append(f"    {tag.name} ({len(tag.items)}) <{link}.rst>")
-        content.append("")
-        filename = os.path.join(outdir, "tagsindex.rst")
-
-    with open(filename, "w", encoding="utf8") as f:
-        f.write("\n".join(content))
+        filename = "tagsindex.rst"
+        lines = _tagpage_rst_lines(tags, title, tags_index_head)
+
+    _write_if_changed(os.path.join(outdir, filename), lines)
+    return filename
+
+
+def _tagpage_md_lines(tags, title, tags_index_head):
+    """Generate the lines of the Markdown tags overview page"""
+    yield "(tagoverview)="
+    yield ""
+    yield f"# {title}"
+    yield ""
+    # toctree for this page
+    yield "```{toctree}"
+    yield "---"
+    yield f"caption: {tags_index_head}"
+    yield "maxdepth: 1"
+    yield "---"
+    for tag in tags:
+        link = tag.name.replace(" ", "_")
+        yield f"{tag.name} ({len(tag.items)}) <{link}>"
+    yield "```"
+
+
+def _tagpage_rst_lines(tags, title, tags_index_head):
+    """Generate the lines of the reStructuredText tags overview page"""
+    yield ":orphan:"
+    yield ""
+    yield ".. _tagoverview:"
+    yield ""
+    yield title
+    yield "#" * len(title)
+    yield ""
+    # toctree for the page
+    yield ".. toctree::"
+    yield f"    :caption: {tags_index_head}"
+    yield "    :maxdepth: 1"
+    yield ""
+    for tag in tags:
+        link = tag.name.replace(" ", "_")
+        yield f"    {tag.name} ({len(tag.items)}) <{link}.rst>"
+
+
+def _iter_sources(srcdir, extensions, tags_output_dir):
+    """Yield paths of all source files under srcdir with one of the given
+    extensions, walking the tree only once.
+
+    Symlinked files/dirs are followed (see issue gh-28), and hidden
+    files/dirs are skipped, as with ``glob(pattern, recursive=True)``. The
+    generated tag pages in tags_output_dir are skipped as well.
+    """
+    suffixes = tuple(f".{extension}" for extension in extensions)
+    tags_dir = os.path.normpath(os.path.join(srcdir, tags_output_dir))
+    for root, dirs, files in os.walk(srcdir, followlinks=True):
+        dirs[:] = [
+            d
+            for d in dirs
+            if not d.startswith(".")
+            and os.path.normpath(os.path.join(root, d)) != tags_dir
+        ]
+        for file in files:
+            if file.endswith(suffixes) and not file.startswith("."):
+                yield os.path.join(root, file)
 
 
 def assign_entries(app):
     """Assign all found entries to their tag."""
-    pages = []
     tags = {}
-    result = []
-    # glob(pattern, recursive=True) includes the detected srcdir with any
-    # additional symlinked files/dirs (see issue gh-28)
-    for extension in app.config.tags_extension:
-        result.extend(glob(f"{app.srcdir}/**/*.{extension}", recursive=True))
-    for entrypath in result:
-        entry = Entry(entrypath)
+    # Reading and scanning source files is independent per file and mostly
+    # I/O bound, so do it in parallel; tags are then assigned serially.
+    max_workers = min(32, (os.cpu_count() or 1) * 4)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pages = list(
+            executor.map(
+                partial(Entry, srcdir=app.srcdir),
+                _iter_sources(
+                    app.srcdir, app.config.tags_extension, app.config.tags_output_dir
+                ),
+            )
+        )
+    for entry in pages:
         entry.assign_to_tags(tags)
-        pages.append(entry)
     return tags, pages
 
 
@@ -296,30 +403,42 @@ def update_tags(app):
         if not os.path.exists(os.path.join(app.srcdir, tags_output_dir)):
             os.makedirs(os.path.join(app.srcdir, tags_output_dir))
 
-        for file in os.listdir(os.path.join(app.srcdir, tags_output_dir)):
-            if file.endswith("md") or file.endswith("rst"):
-                os.remove(os.path.join(app.srcdir, tags_output_dir, file))
-
         # Create pages for each tag
-        tags, pages = assign_entries(app)
+        tags, _ = assign_entries(app)
+        filenames = set()
         for tag in tags.values():
-            tag.create_file(
-                [item for item in pages if tag.name in item.tags],
-                app.config.tags_extension,
-                tags_output_dir,
-                app.srcdir,
-                app.config.tags_page_title,
-                app.config.tags_page_header,
+            filenames.add(
+                tag.create_file(
+                    tag.items,
+                    app.config.tags_extension,
+                    tags_output_dir,
+                    app.srcdir,
+                    app.config.tags_page_title,
+                    app.config.tags_page_header,
+                )
             )
 
         # Create tags overview page
-        tagpage(
-            tags,
-            os.path.join(app.srcdir, tags_output_dir),
-            app.config.tags_overview_title,
-            app.config.tags_extension,
-            app.config.tags_index_head,
+        filenames.add(
+            tagpage(
+                tags,
+                os.path.join(app.srcdir, tags_output_dir),
+                app.config.tags_overview_title,
+                app.config.tags_extension,
+                app.config.tags_index_head,
+            )
         )
+
+        # Remove pages of tags which are no longer used (avoids having
+        # duplicates after removing/changing some tag)
+        with os.scandir(os.path.join(app.srcdir, tags_output_dir)) as it:
+            for file in it:
+                if (
+                    file.is_file(follow_symlinks=False)
+                    and file.name.endswith((".md", ".rst"))
+                    and file.name not in filenames
+                ):
+                    os.unlink(file.path)
         logger.info("Tags updated", color="white")
     else:
         logger.info(
@@ -327,6 +446,18 @@ def update_tags(app):
         )
 
 
+def compile_badge_colors(app, config):
+    """Compile the glob patterns of tags_badge_colors to regexes.
+
+    Matching the compiled patterns is equivalent to calling fnmatch on each
+    tag, but avoids translating the patterns again for every tag.
+    """
+    app._tags_color_patterns = [
+        (re.compile(fnmatch.translate(os.path.normcase(pattern))), color)
+        for pattern, color in (config.tags_badge_colors or {}).items()
+    ]
+
+
 def setup(app):
     """Setup for Sphinx."""
 
@@ -344,6 +475,9 @@ def setup(app):
     app.add_config_value("tags_create_badges", False, "html")
     app.add_config_value("tags_badge_colors", {}, "html")
 
+    # Colors already looked up for each tag during this build
+    app._tags_color_cache = {}
+
     # internal config values
     app.add_config_value(
         "remove_from_toctrees",
@@ -357,6 +491,7 @@ def setup(app):
     # TODO: tags should be updated after sphinx-gallery is generated, and the
     # gallery is also connected to builder-inited. Are there situations when
     # this will not work?
+    app.connect("config-inited", compile_badge_colors)
     app.connect("builder-inited", update_tags)
     app.add_directive("tags", TagLinks)
 